@@ -1,12 +1,28 @@
 import os
+import asyncio
 import telebot
-from pytube import Search
+from pytube import Search, YouTube
 from pytube.exceptions import VideoUnavailable, PytubeError
 import tempfile
-import threading
+import io
 import logging
-import json
+import re
+import sqlite3
+import shutil
+import time
+import functools
+import aiohttp
+from aiohttp import web
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+try:
+    # uvloop's libuv-based event loop handles the many small HTTP calls with less overhead
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # --- Setup and Configuration ---
 
@@ -21,135 +37,645 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not found. Please set it before running the bot.")
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# All Telegram API calls go through a single asyncio event loop, so many users can be
+# served concurrently without a thread per request.
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# When WEBHOOK_URL is set (e.g. the public URL of the Render service), Telegram pushes updates
+# to a small web server on PORT instead of the bot polling for them. Without it the bot polls,
+# which is convenient for running locally.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+PORT = int(os.environ.get('PORT', '8080'))
+
+# The only update types the bot has handlers for; Telegram doesn't send any others.
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+# YouTube throttles each connection individually, so audio is fetched as several
+# byte ranges in parallel instead of one serial stream.
+DOWNLOAD_PARTS = 8
+
+# Received data is collected per part and written out in blocks of this size, so a download
+# costs a few large writes instead of one per (typically 32 KiB) network read.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# All range downloads share one HTTP session, so connections to YouTube's media servers are
+# kept alive and reused instead of paying a new TCP + TLS handshake for every part.
+DOWNLOAD_CONNECTION_LIMIT = 64
+download_session = None
+
+# At most DOWNLOAD_WORKERS downloads (each with its buffer and ffmpeg process) run at once, so load
+# spikes can't use unbounded memory and CPU or open an unbounded number of connections to YouTube.
+# pytube is blocking, so its calls run on a pool of the same size to keep them off the event loop.
+DOWNLOAD_WORKERS = int(os.environ.get('DL_WORKERS', '8'))
+download_slots = asyncio.Semaphore(DOWNLOAD_WORKERS)
+blocking_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+
+# Chats with a download in progress; each chat gets at most one at a time.
+# Only touched from the event loop, so no lock is needed.
+active_chats = set()
+
+# Uploads currently in progress, keyed by YouTube video_id. Chats asking for the same video
+# at the same time wait for the one upload and re-send its file_id.
+in_flight_uploads = {}
+
+# Audio streams resolved ahead of time for the videos shown as buttons, keyed by video_id,
+# as (expiry time, video, audio_stream, filesize). Resolving takes a second or two, which is
+# hidden behind the time the user spends choosing.
+prefetched_streams = {}
+PREFETCH_TTL = 5 * 60  # seconds
+
+# Prefetching is speculative, so it gets its own small pool and can't hold up real downloads
+PREFETCH_WORKERS = 5
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+# Strong references to running background tasks, so they aren't garbage collected mid-way
+background_tasks = set()
+
+# Temp files are opened for upload with a buffer this large, so the HTTP client's small reads
+# are served from memory instead of each costing a read() syscall.
+UPLOAD_BUFFER_SIZE = 1024 * 1024  # 1 MiB
+
+# YouTube serves audio as WebM/Opus or M4A/AAC. When ffmpeg is installed it is re-encoded to MP3,
+# which Telegram's music player accepts and which is smaller to upload at this bitrate.
+FFMPEG_PATH = shutil.which('ffmpeg')
+AUDIO_BITRATE = os.environ.get('AUDIO_BITRATE', '96k')
+
+# Audio up to this size is downloaded into memory and uploaded without touching the disk.
+IN_MEMORY_MAX_SIZE = 16 * 1024 * 1024  # 16 MiB
+
+# Temp files for audio too large to keep in memory go to RAM-backed /dev/shm where available.
+# Files above the size limit, of unknown size or without room there use the regular (possibly disk-backed) temp dir.
+TMPFS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+TMPFS_MAX_SIZE = 128 * 1024 * 1024  # 128 MiB
+# /dev/shm is often small (64 MiB by default in Docker), so a file only goes there if it fits in
+# the free space next to the files other downloads have already claimed, plus some headroom.
+TMPFS_HEADROOM = 16 * 1024 * 1024  # 16 MiB
+tmpfs_reserved = 0  # bytes of /dev/shm claimed by downloads in progress
+
+# Telegram file_ids of audio that has already been uploaded, keyed by YouTube video_id.
+# Re-sending a file_id skips both the download and the upload.
+AUDIO_CACHE_DB = os.environ.get('AUDIO_CACHE_DB', 'audio_cache.db')
+
+# Number of search results offered to the user as buttons
+SEARCH_RESULTS_LIMIT = 5
+
+# Text worth searching for: not a command and at most 200 characters long
+QUERY_RE = re.compile(r'^[^/].{0,199}$', re.DOTALL)
+
+# Each chat may start SEARCH_RATE_LIMIT searches per minute (token bucket), which bounds
+# the search and download work a single chat can cause.
+SEARCH_RATE_LIMIT = 3
+search_buckets = {}  # chat_id -> (tokens left, time of last update, whether the chat was told it's limited)
+last_bucket_sweep = 0.0
+
+# Button callback_data carries just the 11-character YouTube video id
+VIDEO_ID_RE = re.compile(r'^[\w-]{11}$')
 
 # --- Helper Functions ---
 
-def download_audio_and_send(chat_id, video_url, message_id):
+class RangeRequestsUnsupported(Exception):
+    """Raised when the server doesn't answer an HTTP range request with partial content."""
+
+def start_background_task(coro):
+    """Schedules `coro` on the event loop without waiting for it to finish."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def get_download_session():
+    """Returns the shared HTTP session used for downloads, creating it on first use."""
+    global download_session
+    if download_session is None or download_session.closed:
+        download_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=DOWNLOAD_CONNECTION_LIMIT, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30),
+        )
+    return download_session
+
+def refilled_tokens(bucket, now):
+    """Returns how many tokens `bucket` holds at time `now`."""
+    tokens, updated, _ = bucket
+    return min(SEARCH_RATE_LIMIT, tokens + (now - updated) * SEARCH_RATE_LIMIT / 60)
+
+def take_search_token(chat_id):
     """
-    Handles the entire process of downloading and sending the audio for a specific video.
-    This function is run in a separate thread to prevent the main bot loop from blocking.
+    Takes a token from the search bucket of `chat_id`. Returns (allowed, notify): whether the search may run,
+    and whether the chat just went over its rate limit and should be told so (only once per limited period).
+    """
+    global last_bucket_sweep
+    now = time.monotonic()
+
+    # Buckets that are full again hold no state worth keeping; a bucket refills within a minute,
+    # so sweeping once a minute bounds the dict to recently active chats
+    if now - last_bucket_sweep > 60:
+        for bucket_chat_id, bucket in list(search_buckets.items()):
+            if refilled_tokens(bucket, now) >= SEARCH_RATE_LIMIT:
+                del search_buckets[bucket_chat_id]
+        last_bucket_sweep = now
+
+    bucket = search_buckets.get(chat_id, (SEARCH_RATE_LIMIT, now, False))
+    tokens = refilled_tokens(bucket, now)
+    if tokens < 1:
+        notified = bucket[2]
+        search_buckets[chat_id] = (tokens, now, True)
+        return False, not notified
+    search_buckets[chat_id] = (tokens - 1, now, False)
+    return True, False
+
+def reserve_tmpfs(filesize):
+    """Claims `filesize` bytes of /dev/shm for a temp file. Returns False if it doesn't have room for them."""
+    global tmpfs_reserved
+    if not TMPFS_DIR or filesize > TMPFS_MAX_SIZE:
+        return False
+    stats = os.statvfs(TMPFS_DIR)
+    if stats.f_bavail * stats.f_frsize - tmpfs_reserved < filesize + TMPFS_HEADROOM:
+        return False
+    tmpfs_reserved += filesize
+    return True
+
+def release_tmpfs(filesize):
+    """Gives back /dev/shm space claimed with `reserve_tmpfs` once the temp file is deleted."""
+    global tmpfs_reserved
+    tmpfs_reserved -= filesize
+
+async def run_blocking(func, *args):
+    """Runs the blocking `func(*args)` on the blocking pool and returns its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args))
+
+@functools.lru_cache(maxsize=1024)
+def search_top(query):
+    """Returns the top search results for `query`, caching them for repeat queries."""
+    return tuple(Search(query).results[:SEARCH_RESULTS_LIMIT])
+
+def init_audio_cache():
+    """Creates the audio cache table if it doesn't exist yet."""
+    with closing(sqlite3.connect(AUDIO_CACHE_DB)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS audio_cache (video_id TEXT PRIMARY KEY, file_id TEXT NOT NULL)")
+
+def get_cached_file_id(video_id):
+    """Returns the Telegram file_id previously uploaded for `video_id`, or None."""
+    with closing(sqlite3.connect(AUDIO_CACHE_DB)) as conn:
+        row = conn.execute("SELECT file_id FROM audio_cache WHERE video_id = ?", (video_id,)).fetchone()
+    return row[0] if row else None
+
+def cache_file_id(video_id, file_id):
+    """Remembers the Telegram file_id uploaded for `video_id`."""
+    with closing(sqlite3.connect(AUDIO_CACHE_DB)) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO audio_cache (video_id, file_id) VALUES (?, ?)", (video_id, file_id))
+
+async def fetch_ranges(url, filesize, write_part, parts=DOWNLOAD_PARTS):
     """
-    processing_message = None
-    temp_filepath = None
+    Fetches the file at `url` using `parts` concurrent HTTP range requests.
+    Each received chunk is passed to the coroutine function `write_part(offset, chunk)`.
+    """
+    part_size = -(-filesize // parts)  # ceiling division
+    ranges = [(start, min(start + part_size, filesize) - 1) for start in range(0, filesize, part_size)]
+
+    async def fetch_range(session, start, end=None):
+        # Without an `end` the whole file is requested in a single stream
+        ranged = end is not None
+        headers = {'Range': f'bytes={start}-{end}'} if ranged else {}
+        async with session.get(url, headers=headers) as response:
+            # 200 means the Range header was ignored and 416 that it was refused; other errors are real failures
+            if ranged and response.status in (200, 416):
+                raise RangeRequestsUnsupported(f"Range request answered with HTTP {response.status}")
+            response.raise_for_status()
+
+            # A partial response must cover exactly the requested range
+            if ranged:
+                content_range = response.headers.get('Content-Range', '')
+                if not content_range.startswith(f'bytes {start}-{end}/'):
+                    raise aiohttp.ClientPayloadError(f"Expected bytes {start}-{end}, got Content-Range {content_range!r}")
+
+            # The body must be exactly the bytes expected for this part
+            limit = end + 1 if ranged else filesize
+            if response.content_length is not None and start + response.content_length > limit:
+                raise aiohttp.ClientPayloadError(f"Response of {response.content_length} bytes is larger than expected")
+            offset = start
+            pending = bytearray()
+            async for chunk in response.content.iter_any():
+                if offset + len(pending) + len(chunk) > limit:
+                    raise aiohttp.ClientPayloadError(f"Received more than the expected {limit - start} bytes")
+                pending += chunk
+                if len(pending) >= DOWNLOAD_CHUNK_SIZE:
+                    await write_part(offset, pending)
+                    offset += len(pending)
+                    pending = bytearray()
+            if pending:
+                await write_part(offset, pending)
+                offset += len(pending)
+            if offset != limit:
+                raise aiohttp.ClientPayloadError(f"Received {offset - start} of the expected {limit - start} bytes")
+
+    session = await get_download_session()
+    tasks = [asyncio.ensure_future(fetch_range(session, start, end)) for start, end in ranges]
     try:
-        # Send a "typing" action and a message to the user to indicate processing
-        bot.send_chat_action(chat_id, 'typing')
-        processing_message = bot.edit_message_text("Getting audio for your selected song...", chat_id, message_id)
+        await asyncio.gather(*tasks)
+    except RangeRequestsUnsupported as e:
+        logger.warning(f"{e}, falling back to a single stream")
+        for task in tasks:
+            task.cancel()
+        # Collect the other parts' outcomes so their errors aren't reported as never retrieved
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await fetch_range(session, 0)
+    finally:
+        # Don't leave other parts running if one of them failed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-        # Get the video object from the URL
-        video = Search(video_url).results[0]
-        logger.info(f"Downloading audio for: {video.title} ({video.watch_url})")
+async def transcode_to_mp3(source):
+    """
+    Re-encodes audio to MP3 with ffmpeg and returns the encoded bytes.
+    `source` is either the audio itself or the path of a file containing it.
+    """
+    piped = not isinstance(source, str)
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, '-loglevel', 'error', '-i', 'pipe:0' if piped else source,
+        '-vn', '-c:a', 'libmp3lame', '-b:a', AUDIO_BITRATE, '-f', 'mp3', 'pipe:1',
+        stdin=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate(source if piped else None)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    return stdout
 
-        # Get the audio stream with the highest bitrate
-        audio_stream = video.streams.filter(only_audio=True).order_by('bitrate').desc().first()
-        
-        if not audio_stream:
-            bot.edit_message_text("Sorry, no audio streams found for this video.", chat_id, processing_message.message_id)
-            logger.warning(f"No audio streams found for video: {video.title}")
+async def download_stream_to_memory(url, filesize):
+    """Downloads the file at `url` into an in-memory buffer and returns it."""
+    buffer = bytearray(filesize)
+    view = memoryview(buffer)
+
+    async def write_part(offset, chunk):
+        view[offset:offset + len(chunk)] = chunk
+
+    await fetch_ranges(url, filesize, write_part)
+    return buffer
+
+async def download_stream_to_file(url, filesize, filepath):
+    """Downloads the file at `url` into `filepath`."""
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT)
+    pending_writes = set()
+
+    async def write_part(offset, chunk):
+        # Disk writes run off the event loop. They use the default executor rather than the
+        # blocking pool, so they never queue behind slow pytube calls.
+        write = asyncio.ensure_future(asyncio.to_thread(os.pwrite, fd, chunk, offset))
+        pending_writes.add(write)
+        write.add_done_callback(pending_writes.discard)
+        await asyncio.shield(write)
+
+    try:
+        # Preallocate the file so every part can be written at its own offset
+        os.ftruncate(fd, filesize)
+        await fetch_ranges(url, filesize, write_part)
+    finally:
+        # A cancelled part may still have a write running; the fd must stay open until it's done
+        if pending_writes:
+            await asyncio.wait(pending_writes)
+        os.close(fd)
+
+def upload_filename(title, extension):
+    """Returns the filename to upload audio for a video titled `title` under."""
+    # telebot uploads only the base name of a file object's name, so "AC/DC - ..." would lose its start
+    safe_title = title.replace('/', '_').replace('\\', '_')
+    return f"{safe_title}.{extension}"
+
+def resolve_audio_stream(video):
+    """
+    Returns the audio stream with the highest bitrate for `video` together with its size in bytes
+    (preferring M4A when there is no ffmpeg to re-encode it),
+    or (None, None) if the video has no audio streams. This performs blocking network requests.
+    """
+    audio_streams = video.streams.filter(only_audio=True)
+    if not FFMPEG_PATH:
+        # Without ffmpeg the stream is uploaded as-is, and Telegram only treats MP3/M4A as audio
+        audio_streams = audio_streams.filter(subtype='mp4') or audio_streams
+    audio_stream = audio_streams.order_by('bitrate').desc().first()
+    if not audio_stream:
+        return None, None
+    return audio_stream, audio_stream.filesize
+
+def get_prefetched_stream(video_id):
+    """Returns the prefetched (video, audio_stream, filesize) for `video_id`, or None if there is none or it expired."""
+    entry = prefetched_streams.get(video_id)
+    if not entry or entry[0] < time.monotonic():
+        return None
+    return entry[1:]
+
+async def prefetch_audio_streams(videos):
+    """Resolves the audio streams of `videos` concurrently and keeps them for a later download."""
+    now = time.monotonic()
+    for video_id, entry in list(prefetched_streams.items()):
+        if entry[0] < now:
+            del prefetched_streams[video_id]
+
+    loop = asyncio.get_running_loop()
+
+    async def prefetch(video):
+        if get_prefetched_stream(video.video_id):
             return
+        # Search results are cached along with the stream URLs pytube stores on them, and those URLs
+        # expire after a few hours; a fresh object makes sure the resolved URLs are current
+        video = YouTube.from_id(video.video_id)
+        try:
+            audio_stream, filesize = await loop.run_in_executor(prefetch_executor, resolve_audio_stream, video)
+        except Exception as e:
+            logger.warning(f"Could not prefetch audio stream for {video.video_id}: {e}")
+            return
+        prefetched_streams[video.video_id] = (time.monotonic() + PREFETCH_TTL, video, audio_stream, filesize)
 
-        # Use a temporary file to save the audio
-        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as temp_file:
-            temp_filepath = temp_file.name
-        
-        logger.info(f"Starting download of audio to {temp_filepath}")
-        audio_stream.download(output_path=os.path.dirname(temp_filepath), filename=os.path.basename(temp_filepath))
-        logger.info("Download completed.")
+    await asyncio.gather(*(prefetch(video) for video in videos))
+
+async def download_and_upload_audio(chat_id, video_id):
+    """
+    Downloads the best audio stream of the video `video_id`, sends it to `chat_id` and caches its file_id.
+    Returns (file_id, as_document): the Telegram file_id of the upload (None if the video has no audio streams)
+    and whether Telegram stored it as a document rather than as audio.
+    """
+    async with download_slots:
+        temp_filepath = None
+        tmpfs_claim = 0
+        try:
+            # Get the audio stream with the highest bitrate, unless it was already resolved while the user was choosing
+            prefetched = get_prefetched_stream(video_id)
+            if prefetched:
+                video, audio_stream, filesize = prefetched
+            else:
+                video = YouTube.from_id(video_id)
+                audio_stream, filesize = await run_blocking(resolve_audio_stream, video)
+
+            if not audio_stream:
+                logger.warning(f"No audio streams found for video: {video.title}")
+                return None, False
+
+            logger.info(f"Downloading audio for: {video.title} ({video.watch_url})")
+
+            # The stream's real container, e.g. "m4a" for audio/mp4 or "webm" for audio/webm
+            extension = 'm4a' if audio_stream.subtype == 'mp4' else audio_stream.subtype
+
+            if filesize and filesize <= IN_MEMORY_MAX_SIZE:
+                # Small files are kept in memory and never touch the disk
+                logger.info(f"Starting in-memory download of audio ({filesize} bytes)")
+                source = await download_stream_to_memory(audio_stream.url, filesize)
+            else:
+                # Use a temporary file to save the audio
+                temp_dir = None
+                if filesize and reserve_tmpfs(filesize):
+                    temp_dir, tmpfs_claim = TMPFS_DIR, filesize
+                with tempfile.NamedTemporaryFile(suffix=f'.{extension}', dir=temp_dir, delete=False) as temp_file:
+                    temp_filepath = temp_file.name
+
+                logger.info(f"Starting download of audio to {temp_filepath}")
+                if filesize:
+                    await download_stream_to_file(audio_stream.url, filesize, temp_filepath)
+                else:
+                    # Without a known size the file can't be split, so fall back to pytube's serial download
+                    await run_blocking(audio_stream.download, os.path.dirname(temp_filepath), os.path.basename(temp_filepath))
+                source = temp_filepath
+            logger.info("Download completed.")
+
+            # In-memory uploads are named after the video, as the name is used as the upload's filename
+            if FFMPEG_PATH:
+                audio_file = io.BytesIO(await transcode_to_mp3(source))
+                audio_file.name = upload_filename(video.title, 'mp3')
+            elif isinstance(source, str):
+                audio_file = open(source, 'rb', buffering=UPLOAD_BUFFER_SIZE)
+            else:
+                audio_file = io.BytesIO(source)
+                audio_file.name = upload_filename(video.title, extension)
+
+            # Send the audio file to the user
+            with audio_file:
+                audio_message = await bot.send_audio(chat_id, audio_file)
+
+            if audio_message.audio:
+                file_id = audio_message.audio.file_id
+                await asyncio.to_thread(cache_file_id, video_id, file_id)
+                return file_id, False
+
+            # Uploads Telegram doesn't recognise as audio come back as documents. Their file_id only works
+            # with sendDocument, so it is passed to chats waiting on this upload but not cached.
+            return audio_message.document.file_id, True
+
+        finally:
+            # Clean up the temporary file
+            if temp_filepath and os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+                logger.info(f"Deleted temporary file: {temp_filepath}")
+            if tmpfs_claim:
+                release_tmpfs(tmpfs_claim)
+
+async def send_audio_for_video(chat_id, video_id):
+    """
+    Sends the audio of the video `video_id` to `chat_id`, re-using an earlier or in-flight upload when possible.
+    Returns the Telegram file_id of the audio, or None if the video has no audio streams.
+    """
+    # Audio that was sent before can be re-sent by its file_id without downloading it again.
+    # The lookup runs off the event loop, but not on the blocking pool, where it could wait behind pytube.
+    cached_file_id = await asyncio.to_thread(get_cached_file_id, video_id)
+    if cached_file_id:
+        try:
+            await bot.send_audio(chat_id, cached_file_id)
+            logger.info(f"Sent cached audio for video: {video_id}")
+            return cached_file_id
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            logger.warning(f"Cached file_id for {video_id} was rejected, downloading again: {e}")
+
+    in_flight = in_flight_uploads.get(video_id)
+    if in_flight:
+        # Another chat is already fetching this video; reuse its upload instead of downloading it twice.
+        # The upload is shielded so that this chat giving up doesn't cancel it for the other one.
+        logger.info(f"Waiting for in-flight download of video: {video_id}")
+        file_id, as_document = await asyncio.shield(in_flight)
+        if file_id:
+            send = bot.send_document if as_document else bot.send_audio
+            await send(chat_id, file_id)
+        return file_id
+
+    upload = asyncio.ensure_future(download_and_upload_audio(chat_id, video_id))
+    in_flight_uploads[video_id] = upload
+    try:
+        file_id, _ = await upload
+        return file_id
+    finally:
+        del in_flight_uploads[video_id]
+
+async def download_audio_and_send(chat_id, video_id, message_id):
+    """
+    Handles the entire process of downloading and sending the audio for a specific video.
+    This function is run as a background task so the button click can be answered right away.
+    """
+    # The status message is updated while the work runs instead of delaying it by a round-trip
+    status_update = asyncio.ensure_future(bot.edit_message_text("Getting audio for your selected song...", chat_id, message_id))
+    error_text = None
+    try:
+        file_id = await send_audio_for_video(chat_id, video_id)
+        if not file_id:
+            error_text = "Sorry, no audio streams found for this video."
 
-        # Send the audio file to the user
-        with open(temp_filepath, 'rb') as audio_file:
-            bot.send_audio(chat_id, audio_file)
-            
-        bot.delete_message(chat_id, processing_message.message_id)
-        
     except (PytubeError, VideoUnavailable) as e:
         error_message = f"YouTube error occurred: {e}"
         logger.error(error_message)
-        bot.edit_message_text(f"Sorry, a YouTube-related error occurred while processing your request: {e}", chat_id, message_id)
+        error_text = f"Sorry, a YouTube-related error occurred while processing your request: {e}"
             
     except Exception as e:
         error_message = f"An unexpected error occurred: {e}"
         logger.error(error_message)
-        bot.edit_message_text("An unexpected error occurred while processing your request. The developer has been notified.", chat_id, message_id)
+        error_text = "An unexpected error occurred while processing your request. The developer has been notified."
             
     finally:
-        # Clean up the temporary file
-        if temp_filepath and os.path.exists(temp_filepath):
-            os.remove(temp_filepath)
-            logger.info(f"Deleted temporary file: {temp_filepath}")
+        active_chats.discard(chat_id)
+
+    # Let the status update land first so it can't overwrite the final state of the message
+    await asyncio.gather(status_update, return_exceptions=True)
+    if error_text:
+        await bot.edit_message_text(error_text, chat_id, message_id)
+    else:
+        await bot.delete_message(chat_id, message_id)
 
 # --- Bot Command Handers ---
 
 @bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
+async def send_welcome(message):
     """Handles the /start and /help commands."""
     help_text = (
         "Hello! I am a YouTube Music Bot.\n"
         "Just send me the name of a song or artist, and I'll give you a list of results to choose from."
     )
-    bot.reply_to(message, help_text)
+    await bot.reply_to(message, help_text)
 
 # --- Main Message Handler ---
 
 @bot.message_handler(content_types=['text'])
-def handle_text_message(message):
+async def handle_text_message(message):
     """Handles all text messages and presents search results as buttons."""
     query = message.text.strip()
-    if len(query) > 0:
-        bot.send_chat_action(message.chat.id, 'typing')
-        processing_message = bot.send_message(message.chat.id, "Searching for your song on YouTube...")
-        
-        try:
-            search_results = Search(query).results
-            if not search_results:
-                bot.edit_message_text("Sorry, I couldn't find any results for that query.", message.chat.id, processing_message.message_id)
-                logger.warning(f"No search results found for query: {query}")
-                return
+    # Ignore unknown commands and overly long messages before doing any work for them
+    if not QUERY_RE.match(query):
+        return
 
-            keyboard = types.InlineKeyboardMarkup()
-            for i, video in enumerate(search_results[:5]):  # Show top 5 results
-                # Use a dictionary to store both the URL and a new message_id
-                # This is necessary because we need the message ID to edit it later
-                callback_data = json.dumps({'url': video.watch_url, 'message_id': processing_message.message_id})
-                keyboard.add(types.InlineKeyboardButton(f"🎧 {video.title}", callback_data=callback_data))
+    allowed, notify = take_search_token(message.chat.id)
+    if not allowed:
+        # Only the first refused message gets a reply, so flooding the bot doesn't cost an API call per message
+        if notify:
+            await bot.reply_to(message, "You're searching too quickly. Please wait a moment and try again.")
+        return
 
-            bot.edit_message_text("Please choose a song:", message.chat.id, processing_message.message_id, reply_markup=keyboard)
+    # Start the search first so that sending the status message overlaps with it
+    search = asyncio.ensure_future(run_blocking(search_top, query))
+    processing_message = await bot.send_message(message.chat.id, "Searching for your song on YouTube...")
+    
+    try:
+        search_results = await search
+        if not search_results:
+            await bot.edit_message_text("Sorry, I couldn't find any results for that query.", message.chat.id, processing_message.message_id)
+            logger.warning(f"No search results found for query: {query}")
+            return
 
-        except Exception as e:
-            logger.error(f"Error during search: {e}")
-            bot.edit_message_text("An error occurred during the search. Please try again.", message.chat.id, processing_message.message_id)
+        keyboard = types.InlineKeyboardMarkup()
+        for i, video in enumerate(search_results):
+            # Only the video id is stored; the message to edit later is the one carrying the buttons,
+            # which Telegram sends back with the callback query
+            callback_data = video.video_id
+            keyboard.add(types.InlineKeyboardButton(f"🎧 {video.title}", callback_data=callback_data))
+
+        await bot.edit_message_text("Please choose a song:", message.chat.id, processing_message.message_id, reply_markup=keyboard)
+
+        # Resolve the audio streams while the user is choosing, so the download can start right after the click
+        start_background_task(prefetch_audio_streams(search_results))
+
+    except Exception as e:
+        logger.error(f"Error during search: {e}")
+        await bot.edit_message_text("An error occurred during the search. Please try again.", message.chat.id, processing_message.message_id)
 
 # --- Callback Query Handler (for button clicks) ---
 
 @bot.callback_query_handler(func=lambda call: True)
-def handle_callback_query(call):
+async def handle_callback_query(call):
     """Handles button clicks and initiates the download."""
     try:
-        data = json.loads(call.data)
-        video_url = data['url']
-        message_id = data['message_id']
-        
+        if not VIDEO_ID_RE.match(call.data):
+            logger.error(f"Invalid callback data: {call.data}")
+            await bot.answer_callback_query(call.id, text="Error: Invalid button data.")
+            return
+
+        video_id = call.data
+        message_id = call.message.message_id
+        chat_id = call.message.chat.id
+
+        if chat_id in active_chats:
+            await bot.answer_callback_query(call.id, text="Please wait until your current download finishes.")
+            return
+        active_chats.add(chat_id)
+
+        # Run the download in the background so this handler returns immediately
+        start_background_task(download_audio_and_send(chat_id, video_id, message_id))
+
         # Respond to the callback query to remove the loading clock
-        bot.answer_callback_query(call.id, text="Downloading...")
-        
-        # Start the download process in a new thread
-        threading.Thread(target=download_audio_and_send, args=(call.message.chat.id, video_url, message_id)).start()
+        await bot.answer_callback_query(call.id, text="Downloading...")
         
-    except json.JSONDecodeError:
-        logger.error(f"Invalid callback data: {call.data}")
-        bot.answer_callback_query(call.id, text="Error: Invalid button data.")
     except Exception as e:
         logger.error(f"Error handling callback: {e}")
-        bot.answer_callback_query(call.id, text="An unexpected error occurred.")
+        await bot.answer_callback_query(call.id, text="An unexpected error occurred.")
+
+
+# --- Webhook Server ---
+
+async def handle_webhook(request):
+    """Receives an update pushed by Telegram and hands it to the bot's handlers."""
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+
+    update = types.Update.de_json(await request.text())
+    # Reply to Telegram right away; handlers can take a while and Telegram retries slow deliveries
+    start_background_task(bot.process_new_updates([update]))
+    return web.Response()
 
+async def run_webhook():
+    """Registers the webhook with Telegram and serves it until the process is stopped."""
+    # Updates that piled up while the bot was down are dropped rather than processed late
+    await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+
+    app = web.Application()
+    app.router.add_post('/', handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"Webhook server listening on port {PORT}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 # --- Main Bot Loop ---
 
+async def run_bot():
+    """Receives updates through the webhook or by polling, and closes shared sessions on exit."""
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # getUpdates fails with 409 Conflict while a webhook is registered, e.g. from an earlier run with WEBHOOK_URL
+            await bot.delete_webhook(drop_pending_updates=True)
+            await bot.infinity_polling(timeout=50, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        if download_session:
+            await download_session.close()
+        await bot.close_session()
+
 def main():
     """Starts the bot and keeps it running."""
     logger.info("Bot is starting...")
-    bot.infinity_polling()
+    init_audio_cache()
+    if uvloop:
+        uvloop.run(run_bot())
+    else:
+        asyncio.run(run_bot())
 
 if __name__ == "__main__":
     main()